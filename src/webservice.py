@@ -1,5 +1,9 @@
-from http.cookies import SimpleCookie
+from email.utils import parsedate_to_datetime
 from http import HTTPStatus
+import asyncio
+import random
+import re
+import time
 import typing as t
 import aiohttp
 import json
@@ -7,29 +11,76 @@ import base64
 import logging
 
 import yarl
-from galaxy.http import create_client_session, handle_exception
+from galaxy.http import create_client_session, create_tcp_connector, handle_exception
 from galaxy.api.errors import UnknownBackendResponse
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import ijson
+except ImportError:
+    ijson = None  # type: ignore[assignment]
+
 from model.download import TroveDownload, DownloadStructItem
 from model.subscription import MontlyContentData, ChoiceContentData, ChoiceMarketingData, ChoiceMonth
 
 
+logger = logging.getLogger(__name__)
+
+
+class _HandleException:
+    """Class-based stand-in for galaxy.http.handle_exception.
+    The generator-based @contextmanager pays a frame setup per call even when
+    nothing goes wrong; here the original translator is entered only on failure.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            return False
+        with handle_exception():
+            raise exc_val
+
+
 class AuthorizedHumbleAPI:
+    """Client for authorized humblebundle.com endpoints.
+
+    Keep one instance alive for the whole plugin lifetime (or use it as an
+    async context manager) - constructing it per operation throws away the
+    connection pool and per-session caches. The underlying http session is
+    created lazily on first request, so the constructor itself is free and
+    does not bind to whatever event loop happens to be current.
+    """
     _AUTHORITY = "https://www.humblebundle.com/"
     _PROCESS_LOGIN = "processlogin"
     _ORDER_LIST_URL = "api/v1/user/order"
-    _ORDER_URL = "/api/v1/order/{}"
+    # endpoints built per-call are precompiled as yarl.URL so only the varying part is parsed
+    _ORDER_URL = yarl.URL('api/v1/order')
 
     TROVES_PER_CHUNK = 20
     _SUBSCRIPTION = 'subscription'
     _SUBSCRIPTION_HOME = 'subscription/home'
     _SUBSCRIPTION_TROVE = 'subscription/trove'
-    _SUBSCRIPTION_PRODUCTS = 'api/v1/subscriptions/humble_monthly/subscription_products_with_gamekeys'
-    _SUBSCRIPTION_HISTORY = 'api/v1/subscriptions/humble_monthly/history?from_product={}'
-    _TROVE_CHUNK_URL = 'api/v1/trove/chunk?property=popularity&direction=desc&index={}'
+    _SUBSCRIPTION_PRODUCTS = yarl.URL('api/v1/subscriptions/humble_monthly/subscription_products_with_gamekeys')
+    _SUBSCRIPTION_HISTORY = yarl.URL('api/v1/subscriptions/humble_monthly/history')
+    _TROVE_CHUNK_URL = yarl.URL('api/v1/trove/chunk').with_query(property='popularity', direction='desc')
     _DOWNLOAD_SIGN = 'api/v1/user/download/sign'
     _HUMBLER_REDEEM_DOWNLOAD = 'humbler/redeemdownload'
 
+    WEBPACK_CACHE_TTL = 60  # seconds; webpack pages change rarely but are requested repeatedly during one sync
+
+    _AUTH_COOKIE_NAME = '_simpleauth_sess'
+    _AUTH_COOKIE_EXPIRY_SKEW = 60  # seconds; near-expiry cookies still get the http probe
+
+    _RETRY_ATTEMPTS = 3
+    _RETRY_BACKOFF = 0.5  # seconds, doubled per attempt
+    _RETRYABLE_STATUSES = (HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.SERVICE_UNAVAILABLE)
+
     _DEFAULT_HEADERS = {
         "Accept": "application/json",
         "Accept-Charset": "utf-8",
@@ -37,67 +88,157 @@ class AuthorizedHumbleAPI:
         "User-Agent": "HumbleBundle plugin for GOG Galaxy 2.0"
     }
 
-    def __init__(self):
-        self._session = create_client_session(headers=self._DEFAULT_HEADERS)
+    def __init__(self, connector: t.Optional[aiohttp.BaseConnector] = None):
+        self._base_url = yarl.URL(self._AUTHORITY)
+        self._connector = connector
+        self.__session: t.Optional[aiohttp.ClientSession] = None
+        self._pending_redeem: t.Set[asyncio.Task] = set()
+        self._webpack_cache: t.Dict[str, t.Tuple[float, dict]] = {}
+
+    @property
+    def _session(self) -> aiohttp.ClientSession:
+        if self.__session is None:
+            connector = self._connector
+            if connector is None:
+                # all requests hit one host; keep idle connections warm well over the
+                # 15s aiohttp default to avoid repeated TLS handshakes and DNS lookups
+                connector = create_tcp_connector(
+                    keepalive_timeout=120,
+                    ttl_dns_cache=300,
+                    limit_per_host=32,
+                    enable_cleanup_closed=True
+                )
+            self.__session = create_client_session(connector=connector, headers=self._DEFAULT_HEADERS)
+        return self.__session
+
+    async def __aenter__(self) -> 'AuthorizedHumbleAPI':
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close_session()
 
     @property
     def is_authenticated(self) -> bool:
         return bool(self._session.cookie_jar)
 
     async def _request(self, method, path, *args, **kwargs):
-        url = self._AUTHORITY + path
-        logging.debug(f'{method}, {url}, {args}, {kwargs}')
-        with handle_exception():
-            return await self._session.request(method, url, *args, **kwargs)
+        # joining with a prebuilt yarl.URL skips re-parsing the authority on every call
+        url = self._base_url.join(yarl.URL(path))
+        if logger.isEnabledFor(logging.DEBUG):  # params/json kwargs may be large; do not format them for nothing
+            logger.debug('%s, %s, %s, %s', method, url, args, kwargs)
+        with _HandleException():
+            for attempt in range(self._RETRY_ATTEMPTS):
+                last_attempt = attempt == self._RETRY_ATTEMPTS - 1
+                try:
+                    res = await self._session.request(method, url, *args, **kwargs)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    if last_attempt:
+                        raise
+                    retry_reason = repr(e)
+                except aiohttp.ClientResponseError as e:
+                    if last_attempt or e.status not in self._RETRYABLE_STATUSES:
+                        raise
+                    retry_reason = f'status {e.status}'
+                else:
+                    if last_attempt or res.status not in self._RETRYABLE_STATUSES:
+                        return res
+                    retry_reason = f'status {res.status}'
+                    await res.release()  # do not hold the connection during backoff
+                delay = self._RETRY_BACKOFF * 2 ** attempt + random.uniform(0, 0.1)
+                logger.warning(f'{retry_reason} for {url}; retry in {delay:.2f}s')
+                await asyncio.sleep(delay)
+
+    async def _json(self, res: aiohttp.ClientResponse):
+        return json_loads(await res.read())
+
+    def _auth_cookie_expires(self) -> t.Optional[float]:
+        """Returns unix time when the session cookie expires or None if unknown."""
+        for cookie in self._session.cookie_jar:
+            if cookie.key == self._AUTH_COOKIE_NAME and cookie['expires']:
+                try:
+                    return parsedate_to_datetime(cookie['expires']).timestamp()
+                except (TypeError, ValueError):
+                    return None
+        return None
 
     async def _is_session_valid(self):
-        """Simply asks about order list to know if session is valid.
+        """Checks the session cookie expiry first to spare a network roundtrip;
+        if unknown, simply asks about order list to know if session is valid.
         galaxy.api.errors instances cannot be catched so galaxy.http.handle_excpetion
         is the final check with all the logic under its context.
         """
-        with handle_exception():
+        expires = self._auth_cookie_expires()
+        if expires is not None and expires > time.time() + self._AUTH_COOKIE_EXPIRY_SKEW:
+            return True
+        with _HandleException():
             try:
-                await self._session.request('get', self._AUTHORITY + self._ORDER_LIST_URL)
+                await self._session.request('get', self._base_url.join(yarl.URL(self._ORDER_LIST_URL)))
             except aiohttp.ClientResponseError as e:
                 if e.status == HTTPStatus.UNAUTHORIZED:
                     return False
                 raise
         return True
 
+    _USER_ID_RE = re.compile(rb'"user_id"\s*:\s*"?([^",}]+)')
+
     def _decode_user_id(self, _simpleauth_sess):
         info = _simpleauth_sess.split('|')[0]
         info += '=='  # ensure full padding
-        decoded = json.loads(base64.b64decode(info))
-        return decoded['user_id']
+        raw = base64.b64decode(info)
+        # pluck user_id directly from the decoded bytes; the rest of the blob is unused
+        match = self._USER_ID_RE.search(raw)
+        if match is not None:
+            return match.group(1).decode()
+        return json_loads(raw)['user_id']
 
     async def authenticate(self, auth_cookie: dict) -> t.Optional[str]:
-        # recreate original cookie
-        cookie = SimpleCookie()
-        cookie_val = bytes(auth_cookie['value'], "utf-8").decode("unicode_escape")
+        # recreate original cookie value
+        cookie_val = auth_cookie['value'].encode().decode("unicode_escape")
         # some users have cookies with escaped characters, some not...
         # for the first group strip quotes:
         cookie_val = cookie_val.replace('"', '')
-        cookie[auth_cookie['name']] = cookie_val
 
-        self._session.cookie_jar.update_cookies(cookie)
+        # a plain dict skips the SimpleCookie parser; response_url scopes the cookie to our host
+        self._session.cookie_jar.update_cookies(
+            {auth_cookie['name']: cookie_val}, response_url=self._base_url)
+        self._webpack_cache.clear()  # do not leak pages fetched for a previous login
         return self._decode_user_id(cookie_val)
 
     async def get_gamekeys(self) -> t.List[str]:
         res = await self._request('get', self._ORDER_LIST_URL)
-        parsed = await res.json()
-        logging.info(f"The order list:\n{parsed}")
-        gamekeys = [it["gamekey"] for it in parsed]
+        if ijson is not None:
+            # stream gamekeys as body bytes arrive; peak memory stays at one order object
+            # instead of the whole order list
+            gamekeys = [key async for key in ijson.items_async(res.content, 'item.gamekey')]
+        else:
+            parsed = await self._json(res)
+            gamekeys = [it["gamekey"] for it in parsed]
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("The order list:\n%s", gamekeys)
         return gamekeys
 
     async def get_order_details(self, gamekey) -> dict:
-        res = await self._request('get', self._ORDER_URL.format(gamekey), params={
+        res = await self._request('get', self._ORDER_URL / gamekey, params={
             'all_tpkds': 'true'
         })
-        return await res.json()
+        return await self._json(res)
+
+    async def get_all_order_details(self, gamekeys: t.Iterable[str], concurrency: int = 16) -> t.List[dict]:
+        """Fetches order details for all `gamekeys` concurrently.
+        Orders are independent GETs so firing them under a semaphore
+        cuts total latency from N * RTT to roughly ceil(N / concurrency) * RTT.
+        """
+        sem = asyncio.Semaphore(concurrency)
+
+        async def _one(gamekey):
+            async with sem:
+                return await self.get_order_details(gamekey)
+
+        return await asyncio.gather(*(_one(gamekey) for gamekey in gamekeys))
 
     async def _get_trove_details(self, chunk_index) -> list:
-        res = await self._request('get', self._TROVE_CHUNK_URL.format(chunk_index))
-        return await res.json()
+        res = await self._request('get', self._TROVE_CHUNK_URL.update_query(index=chunk_index))
+        return await self._json(res)
 
     async def get_subscription_products_with_gamekeys(self) -> t.AsyncGenerator[dict, None]:
         """
@@ -109,17 +250,45 @@ class AuthorizedHumbleAPI:
         For Choice: `gamekey` field presence means user has unlocked that month and made choices.
         For Monhly: `download_url` field presence means user has subscribed this month.
         """
-        cursor = ''
-        while True:
-            res = await self._request('GET', self._SUBSCRIPTION_PRODUCTS + f"/{cursor}", raise_for_status=False)
-            if res.status == 404:  # Ends with "Humble Monthly" in November 2015
-                return
-            with handle_exception():
-                res.raise_for_status()
-            res_json = await res.json()
-            for product in res_json['products']:
-                yield product
-            cursor = res_json['cursor']
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+
+        async def fetch_pages():
+            """Fetches next page as soon as previous cursor is known,
+            overlapping the request with consumer processing.
+            Puts None on the last page; exceptions are passed to the consumer.
+            """
+            cursor = ''
+            try:
+                while True:
+                    res = await self._request('GET', self._SUBSCRIPTION_PRODUCTS / cursor, raise_for_status=False)
+                    if res.status == 404:  # Ends with "Humble Monthly" in November 2015
+                        break
+                    with _HandleException():
+                        res.raise_for_status()
+                    res_json = await self._json(res)
+                    cursor = res_json['cursor']
+                    await queue.put(res_json['products'])
+            except asyncio.CancelledError:
+                # on py3.7 CancelledError is an Exception; re-raise so consumer's
+                # cancel is not swallowed (and put on a full queue would hang)
+                raise
+            except Exception as e:
+                await queue.put(e)
+            else:
+                await queue.put(None)
+
+        producer = asyncio.create_task(fetch_pages())
+        try:
+            while True:
+                products = await queue.get()
+                if products is None:
+                    return
+                if isinstance(products, Exception):
+                    raise products
+                for product in products:
+                    yield product
+        finally:
+            producer.cancel()
 
     async def get_subscription_history(self, from_product: str) -> aiohttp.ClientResponse:
         """
@@ -128,7 +297,8 @@ class AuthorizedHumbleAPI:
         for example 'february_2020_choice' to got a few month data items including
         'january_2020_choice', 'december_2019_choice', 'december_2020_monthly'
         """
-        return await self._request('GET', self._SUBSCRIPTION_HISTORY.format(from_product), raise_for_status=False)
+        return await self._request(
+            'GET', self._SUBSCRIPTION_HISTORY.with_query(from_product=from_product), raise_for_status=False)
 
     async def get_previous_subscription_months(self, from_product: str):
         """Generator wrapper for get_subscription_history previous months"""
@@ -136,9 +306,9 @@ class AuthorizedHumbleAPI:
             res = await self.get_subscription_history(from_product)
             if res.status == 404:
                 return
-            with handle_exception():
+            with _HandleException():
                 res.raise_for_status()
-            data = await res.json()
+            data = await self._json(res)
             if not data['previous_months']:
                 return
             for prev_month in data['previous_months']:
@@ -155,19 +325,27 @@ class AuthorizedHumbleAPI:
         elif res.status == 302:
             return False
         else:
-            logging.warning(f'{self._SUBSCRIPTION_HOME}, Status code: {res.status}')
+            logger.warning(f'{self._SUBSCRIPTION_HOME}, Status code: {res.status}')
             return None
 
-    async def _get_webpack_data(self, path: str, webpack_id: str) -> dict:
+    async def _get_webpack_data(self, path: str, webpack_id: str, ttl: float=WEBPACK_CACHE_TTL) -> dict:
+        cached = self._webpack_cache.get(path)
+        if cached is not None and time.time() - cached[0] < ttl:
+            return cached[1]
         res = await self._request('GET', path, allow_redirects=False)
-        txt = await res.text()
-        search = f'<script id="{webpack_id}" type="application/json">'
-        json_start = txt.find(search) + len(search)
-        candidate = txt[json_start:].strip()
+        # scan raw bytes and decode only the json block instead of the whole ~200K page
+        raw = await res.read()
+        search = f'<script id="{webpack_id}" type="application/json">'.encode()
+        script_start = raw.find(search)
+        json_end = raw.find(b'</script>', script_start + len(search))
+        if script_start == -1 or json_end == -1:
+            raise UnknownBackendResponse('cannot find webpack data')
+        candidate = raw[script_start + len(search):json_end].strip()
         try:
-            parsed, _ = json.JSONDecoder().raw_decode(candidate)
-        except json.decoder.JSONDecodeError as e:
+            parsed = json_loads(candidate)
+        except ValueError as e:
             raise UnknownBackendResponse('cannot parse webpack data') from e
+        self._webpack_cache[path] = (time.time(), parsed)
         return parsed
 
     async def get_montly_trove_data(self) -> dict:
@@ -203,25 +381,42 @@ class AuthorizedHumbleAPI:
         data = await self._get_webpack_data(url, webpack_id)
         return MontlyContentData(data)
 
-    async def get_trove_details(self, from_chunk: int=0):
+    async def get_trove_details(self, from_chunk: int=0, prefetch: int=1):
+        """Yields trove chunks, prefetching `prefetch` upcoming chunks
+        while the consumer processes the current one - chunks are independent
+        by index so the network stays busy during client-side parsing.
+        """
         index = from_chunk
-        while True:
-            chunk_details = await self._get_trove_details(index)
-            if type(chunk_details) != list:
-                logging.debug(f'chunk_details: {chunk_details}')
-                raise UnknownBackendResponse()
-            elif len(chunk_details) == 0:
-                logging.debug('No more chunk pages')
-                return
-            yield chunk_details
+        pending: t.List[asyncio.Task] = []
+
+        def schedule_next():
+            nonlocal index
+            pending.append(asyncio.create_task(self._get_trove_details(index)))
             index += 1
 
+        for _ in range(1 + prefetch):
+            schedule_next()
+        try:
+            while True:
+                chunk_details = await pending.pop(0)
+                if type(chunk_details) != list:
+                    logger.debug(f'chunk_details: {chunk_details}')
+                    raise UnknownBackendResponse()
+                elif len(chunk_details) == 0:
+                    logger.debug('No more chunk pages')
+                    return
+                schedule_next()
+                yield chunk_details
+        finally:
+            for task in pending:
+                task.cancel()
+
     async def sign_download(self, machine_name: str, filename: str):
         res = await self._request('post', self._DOWNLOAD_SIGN, params={
             'machine_name': machine_name,
             'filename': filename
         })
-        return await res.json()
+        return await self._json(res)
 
     async def _reedem_download(self, download_machine_name: str, custom_data: dict):
         """Unknown purpose - humble http client do this after post for signed_url
@@ -233,36 +428,52 @@ class AuthorizedHumbleAPI:
         }
         params.update(custom_data)
         res = await self._request('post', self._HUMBLER_REDEEM_DOWNLOAD, params=params)
-        content = await res.read()
-        if content != b"{'success': True}":
-            raise UnknownBackendResponse(f'unexpected response while reedem trove download: {content}')
+        expected = b"{'success': True}"
+        try:
+            head = await res.content.readexactly(len(expected))
+        except asyncio.IncompleteReadError as e:
+            head = e.partial
+        await res.release()  # drop the (empty) remainder without buffering it
+        if head != expected:
+            raise UnknownBackendResponse(f'unexpected response while reedem trove download: {head}')
+
+    def _schedule_redeem(self, download_machine_name: str, custom_data: dict):
+        """Fires _reedem_download in background - its result is ignored anyway
+        so there is no reason to delay returning signed urls by one more RTT.
+        """
+        task = asyncio.create_task(self._reedem_download(download_machine_name, custom_data))
+        self._pending_redeem.add(task)
+
+        def on_done(task):
+            self._pending_redeem.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                logger.error(repr(task.exception()) + '. Error ignored')
+
+        task.add_done_callback(on_done)
 
     @staticmethod
     def _filename_from_web_link(link: str):
-        return yarl.URL(link).parts[-1]
+        # "last path segment before ?" - no need for a full yarl.URL parse
+        path = link.split('?', 1)[0]
+        return path.rpartition('/')[2]
 
     async def sign_url_subproduct(self, download: DownloadStructItem, download_machine_name: str):
         if download.web is None:
             raise RuntimeError(f'No download web link in download struct item {download}')
         filename = self._filename_from_web_link(download.web)
         urls = await self.sign_download(download_machine_name, filename)
-        try:
-            await self._reedem_download(
-                download_machine_name, {'download_url_file': filename})
-        except Exception as e:
-            logging.error(repr(e) + '. Error ignored')
+        self._schedule_redeem(download_machine_name, {'download_url_file': filename})
         return urls
 
     async def sign_url_trove(self, download: TroveDownload, product_machine_name: str):
         if download.web is None:
             raise RuntimeError(f'No download web link in download struct item {download}')
         urls = await self.sign_download(download.machine_name, download.web)
-        try:
-            await self._reedem_download(
-                download.machine_name, {'product': product_machine_name})
-        except Exception as e:
-            logging.error(repr(e) + '. Error ignored')
+        self._schedule_redeem(download.machine_name, {'product': product_machine_name})
         return urls
 
     async def close_session(self):
-        await self._session.close()
+        if self._pending_redeem:
+            await asyncio.gather(*self._pending_redeem, return_exceptions=True)
+        if self.__session is not None:
+            await self.__session.close()
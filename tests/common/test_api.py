@@ -1,7 +1,106 @@
+import aiohttp
+import pytest
+from galaxy.api.errors import AuthenticationRequired, NetworkError
+
 from webservice import AuthorizedHumbleAPI
 
 
+class ResponseMock:
+    def __init__(self, status):
+        self.status = status
+        self.released = False
+
+    async def release(self):
+        self.released = True
+
+
+@pytest.fixture
+def api():
+    api = AuthorizedHumbleAPI()
+    api._RETRY_BACKOFF = 0  # no sleeping between attempts in tests
+    return api
+
+
+@pytest.fixture
+def set_session(api, mocker):
+    def fn(request_fn):
+        session = mocker.Mock(spec=())
+        session.request = request_fn
+        mocker.patch.object(
+            AuthorizedHumbleAPI, '_session', mocker.PropertyMock(return_value=session))
+        return session
+    return fn
+
+
+@pytest.mark.asyncio
+async def test_request_retry_then_success(api, set_session):
+    response = ResponseMock(200)
+    attempts = []
+
+    async def request(method, url, *args, **kwargs):
+        attempts.append(url)
+        if len(attempts) == 1:
+            raise aiohttp.ClientConnectionError('transient')
+        return response
+
+    set_session(request)
+    assert response == await api._request('get', 'api/v1/user/order')
+    assert len(attempts) == 2
+
+
+@pytest.mark.asyncio
+async def test_request_retry_exhaustion(api, set_session):
+    attempts = []
+
+    async def request(method, url, *args, **kwargs):
+        attempts.append(url)
+        raise aiohttp.ClientConnectionError('host is down')
+
+    set_session(request)
+    with pytest.raises(NetworkError):
+        await api._request('get', 'api/v1/user/order')
+    assert len(attempts) == api._RETRY_ATTEMPTS
+
+
+@pytest.mark.asyncio
+async def test_request_no_retry_on_not_retryable_status(api, set_session):
+    attempts = []
+
+    async def request(method, url, *args, **kwargs):
+        attempts.append(url)
+        raise aiohttp.ClientResponseError(None, None, status=401, message='no auth')
+
+    set_session(request)
+    with pytest.raises(AuthenticationRequired):
+        await api._request('get', 'api/v1/user/order')
+    assert len(attempts) == 1
+
+
+@pytest.mark.asyncio
+async def test_request_retryable_status_released_before_retry(api, set_session):
+    throttled = ResponseMock(429)
+    response = ResponseMock(200)
+    attempts = []
+
+    async def request(method, url, *args, **kwargs):
+        attempts.append(url)
+        if len(attempts) == 1:
+            return throttled
+        return response
+
+    set_session(request)
+    assert response == await api._request('get', 'api/v1/user/order', raise_for_status=False)
+    assert len(attempts) == 2
+    assert throttled.released
+
+
 def test_filename_from_web_link():
     web_link = 'https://dl.humble.com/Almost_There_Windows.zip?gamekey=AbR9TcsD4ecueNGw&ttl=1587335864&t=a04a9b4f6512b7958f6357cb7b628452'
     expected = 'Almost_There_Windows.zip'
     assert expected == AuthorizedHumbleAPI._filename_from_web_link(web_link)
+
+
+def test_filename_from_web_link_no_query():
+    web_link = 'https://dl.humble.com/torchlight_build_31_2017.zip'
+    expected = 'torchlight_build_31_2017.zip'
+    assert expected == AuthorizedHumbleAPI._filename_from_web_link(web_link)